@@ -2,15 +2,36 @@ from dataclasses import dataclass
 from marshmallow.exceptions import ValidationError
 import pandas
 import numpy as N
+import os
 import re
+import math
+import logging
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
-from decimal import Decimal
-
-# Fancy printing
-from rich import print
 from typing import List, Optional
 from sparrow.core import task, get_database, settings
 
+# Pandas-created suffixes for repeated columns
+_SUFFIX_RE = re.compile(r"\.\d+$")
+# Publication year at the end of a reference
+_YEAR_RE = re.compile(r", (\d{4})$")
+
+# Descriptive columns that are always read as text
+TEXT_COLUMNS = [
+    "SAMPLE ID",
+    "REFERENCE",
+    "MATERIAL",
+    "TYPE",
+    "COMPOSITION",
+    "ROCK NAME",
+    "SOURCE",
+]
+
+log = logging.getLogger(__name__)
+
 
 @task(name="import-earthchem")
 def import_earthchem():
@@ -19,52 +40,224 @@ def import_earthchem():
     """
     data_dir = Path(settings.DATA_DIR)
     files = data_dir.glob("*.txt")
-    for file in files:
+    # Samples are parsed in worker processes, and loaded into the database here.
+    # Workers are forked, because a plugin loaded from SPARROW_PLUGIN_DIR can't
+    # necessarily be imported by name in a fresh interpreter.
+    max_workers = os.cpu_count() or 1
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        # With fork, the first task starts every worker. Do this before reading any
+        # file (which starts Arrow's thread pool) or connecting to the database.
+        executor.submit(os.getpid).result()
+        db = get_database()
         # Read a thousand rows at a time
-        chunks = pandas.read_table(file, sep="\t", chunksize=1000)
+        chunks = (df for file in files for df in read_chunks(file, chunksize=1000))
+        pending = set()
         for df in chunks:
-            df = combine_repeated_columns(df)
-            # Call the import_sample function for each row
-            df.apply(import_sample, axis=1)
+            # Limit the number of chunks waiting in memory
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    load_samples(db, future.result())
+            pending.add(executor.submit(parse_chunk, df))
+        for future in as_completed(pending):
+            load_samples(db, future.result())
 
 
-def import_sample(data):
-    """This function imports a single sample from the EarthChem dump file."""
-    try:
-        _import_sample(data)
-    except Exception:
-        pass
+def parse_chunk(df):
+    """Build all the samples in a chunk of the EarthChem dump, without touching the database."""
+    df = combine_repeated_columns(df)
+    samples = [import_sample(data) for data in extract_sample_data(df)]
+    return [s for s in samples if s is not None]
 
 
-def _import_sample(row):
+def read_chunks(file, chunksize=1000):
     """
-    This function imports a single sample from the EarthChem dump file.
+    Read a tab-separated EarthChem dump file as a series of DataFrames.
+    The multithreaded PyArrow CSV reader is used if it is available.
     """
-    data = {}
-    for col_id, val in row.iteritems():
-        if pandas.isnull(val) or col_id.endswith(" UNIT") or col_id.endswith(" METH"):
-            continue
+    try:
+        import pyarrow
+        from pyarrow import csv
+    except ImportError:
+        # Pandas renames repeated headers (e.g. "SIO2 UNIT.1"), and expects those names here
+        header = pandas.read_table(file, sep="\t", nrows=0).columns
+        text_cols, category_cols = classify_header(header)
+        dtype = {c: str for c in text_cols}
+        dtype.update({c: "category" for c in category_cols})
+        yield from pandas.read_table(file, sep="\t", chunksize=chunksize, dtype=dtype)
+        return
+
+    # PyArrow keeps repeated headers as they are, so we read the raw header row
+    header = pandas.read_table(file, sep="\t", header=None, nrows=1, dtype=str)
+    header = header.iloc[0].fillna("")
+    text_cols, category_cols = classify_header(header)
+    column_types = {c: pyarrow.string() for c in text_cols}
+    category = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    column_types.update({c: category for c in category_cols})
+    # Other types are inferred over the whole file, so they stay consistent between chunks
+    table = csv.read_csv(
+        file,
+        parse_options=csv.ParseOptions(
+            delimiter="\t",
+            newlines_in_values=True,
+            invalid_row_handler=skip_invalid_row,
+        ),
+        # Empty cells are nulls, as they are for pandas
+        convert_options=csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True
+        ),
+    )
+    for start in range(0, table.num_rows, chunksize):
+        # Slicing an Arrow table is zero-copy, so we only convert one chunk at a time
+        yield table.slice(start, chunksize).to_pandas()
+
+
+def skip_invalid_row(row):
+    """Skip malformed rows of a dump, so that they don't abort the whole import."""
+    # Row numbers aren't known when parsing in parallel, so we log the text instead
+    log.warning(
+        "Skipping row with %d columns (expected %d): %s",
+        row.actual_columns,
+        row.expected_columns,
+        row.text,
+    )
+    return "skip"
+
+
+def classify_header(header):
+    """
+    Find the columns of a dump whose types we know up front from the header:
+    descriptive text columns, and unit and method columns.
+    """
+    text_cols = []
+    category_cols = []
+    for col_id in header:
+        name = _SUFFIX_RE.sub("", col_id).strip()
+        if name.endswith((" UNIT", " METH")):
+            # Units and methods repeat heavily, so we store them as categories
+            category_cols.append(col_id)
+        elif name in TEXT_COLUMNS:
+            text_cols.append(col_id)
+    return text_cols, category_cols
+
+
+@lru_cache(maxsize=32)
+def column_plan(columns):
+    """
+    Work out how each value column of a chunk should be parsed, given the tuple
+    of its column names. EarthChem dumps have a fixed header, so this is only
+    computed once per file. Returns a tuple of (column name, position, unit position,
+    method position, is age) for each value column.
+    """
+    # Fixed-width strings let numpy classify all columns in its own string loops
+    names = N.array(columns, dtype=str)
+    unit_mask = N.char.endswith(names, " UNIT")
+    meth_mask = N.char.endswith(names, " METH")
+    positions = {c: ix for ix, c in enumerate(columns)}
+
+    plan = []
+    for ix in N.flatnonzero(~(unit_mask | meth_mask)).tolist():
+        col_id = columns[ix]
         uid = col_id + " UNIT"
         mid = col_id + " METH"
         # Check to see whether we have a defined unit and method
-        if uid in row.index and mid in row.index:
-            unit = row.loc[uid]
-            if pandas.isnull(unit):
-                unit = None
-            if unit is None and "_" in col_id:
-                # We have a composited column name and no unit, which probably means a ratio
-                unit = "ratio"
-            val = Value(val, col_id, str(unit), str(row.loc[mid]))
-            print(f"{col_id}: {val.value} {val.unit} ({val.method})")
-        elif col_id.endswith("AGE"):
-            v1 = float(val)
-            if v1 < 0:
-                # The EarthChem portal uses negative ages to indicate an age in years before present.
-                val = Value(v1 * -1, col_id, "year", "UNKNOWN")
-            else:
-                val = Value(v1, col_id, "Ma", "UNKNOWN")
-
-        data[col_id] = val
+        if uid in positions and mid in positions:
+            plan.append((col_id, ix, positions[uid], positions[mid], False))
+        else:
+            plan.append((col_id, ix, None, None, col_id.endswith("AGE")))
+    return tuple(plan)
+
+
+def extract_sample_data(df):
+    """
+    Prepare the values of a chunk of the EarthChem dump column-by-column,
+    and yield a dictionary of non-null values for each row.
+    """
+    plan = column_plan(tuple(df.columns))
+    # A single null mask for the whole chunk, shared by values and their units
+    missing = df.isna().to_numpy()
+    present = ~missing[:, [ix for _, ix, _, _, _ in plan]]
+    # Samples that can't be imported at all
+    rejected = N.zeros(len(df), dtype=bool)
+
+    names = []
+    value_lists = []
+    unit_lists = []
+    for plan_ix, (col_id, ix, unit_ix, meth_ix, is_age) in enumerate(plan):
+        values = df.iloc[:, ix].to_numpy()
+        units = None
+        methods = None
+        if unit_ix is not None:
+            # A composited column name with no unit probably means a ratio
+            missing_unit = "ratio" if "_" in col_id else "None"
+            units = N.where(
+                missing[:, unit_ix],
+                missing_unit,
+                df.iloc[:, unit_ix].to_numpy(dtype=object).astype(str),
+            )
+            methods = df.iloc[:, meth_ix].to_numpy(dtype=object).astype(str)
+        elif is_age:
+            ages = pandas.to_numeric(df.iloc[:, ix], errors="coerce")
+            ages = ages.to_numpy(dtype=float)
+            # Reject samples with a non-numeric age instead of dropping the value
+            invalid = present[:, plan_ix] & N.isnan(ages)
+            if invalid.any():
+                log.warning(
+                    "Skipping %d samples with a non-numeric %s", invalid.sum(), col_id
+                )
+                rejected |= invalid
+            # The EarthChem portal uses negative ages to indicate an age in years before present.
+            negative = ages < 0
+            values = N.where(negative, -ages, ages)
+            units = N.where(negative, "year", "Ma")
+            methods = N.full(len(ages), "UNKNOWN")
+        # Convert to plain lists up front, so the row loop below works on Python
+        # objects rather than indexing into numpy arrays one scalar at a time.
+        if units is not None:
+            units = list(zip(units.tolist(), methods.tolist()))
+        else:
+            units = repeat(None)
+        names.append(col_id)
+        value_lists.append(values.tolist())
+        unit_lists.append(units)
+
+    debug = log.isEnabledFor(logging.DEBUG)
+    # Walk the rows as plain tuples of values and (unit, method) pairs
+    rows = zip(rejected.tolist(), present.tolist(), zip(*value_lists), zip(*unit_lists))
+    for is_rejected, row_present, row_values, row_units in rows:
+        if is_rejected:
+            continue
+        data = {}
+        for col_id, is_present, val, unit in zip(
+            names, row_present, row_values, row_units
+        ):
+            if not is_present:
+                continue
+            if unit is not None:
+                val = Value(val, col_id, *unit)
+                if debug:
+                    log.debug("%s: %s %s (%s)", col_id, val.value, val.unit, val.method)
+            data[col_id] = val
+        yield data
+
+
+def import_sample(data):
+    """
+    This function builds a single sample from the EarthChem dump file,
+    returning None if it cannot be parsed.
+    """
+    try:
+        return _import_sample(data)
+    except Exception:
+        return None
+
+
+def _import_sample(data):
+    """
+    This function builds a single sample from the EarthChem dump file,
+    given a dictionary of its non-null values.
+    """
 
     post_process_ages(data)
 
@@ -72,7 +265,7 @@ def _import_sample(row):
 
     # Get reference data
     ref = data["REFERENCE"]
-    year = re.search(r", (\d{4})$", ref)
+    year = _YEAR_RE.search(ref)
 
     if year is None:
         raise Exception(f"Could not parse reference {ref}")
@@ -104,16 +297,23 @@ def _import_sample(row):
 
     sample["session"] = build_sessions(data)
 
-    print(sample)
+    log.debug("sample: %r", sample)
 
-    print()
+    return sample
 
-    # Actually load the data into the database
-    db = get_database()
-    try:
-        db.load_data("sample", sample, strict=True)
-    except ValidationError:
-        print("Failed to load sample")
+
+def load_samples(db, samples):
+    """
+    Actually load a chunk's samples into the database. Sparrow has no bulk loader,
+    so each sample is still loaded (and committed) on its own.
+    """
+    for sample in samples:
+        try:
+            db.load_data("sample", sample, strict=True)
+        except ValidationError:
+            log.warning("Failed to load sample %s", sample["name"])
+        except Exception:
+            log.exception("Error loading sample %s", sample["name"])
 
 
 def build_material(data):
@@ -152,7 +352,7 @@ def build_sessions(data):
 
 
 ## Utility functions
-@dataclass
+@dataclass(slots=True)
 class Value:
     """
     A simple class to hold a value and its unit. This could maybe be
@@ -178,9 +378,6 @@ class Value:
             },
         }
 
-    def rounded(self, digits=2):
-        return Decimal(round(self.value, digits))
-
 
 def post_process_ages(data):
     """If MIN and MAX ages are symmetrical around the AGE value, we can assume that these
@@ -192,41 +389,57 @@ def post_process_ages(data):
         return
     # If we have symmetric min and and max ages, we assume that these represent
     # a Gaussian error bound on the age.
-    d1 = age.rounded(5) - min_age.rounded(5)
-    d2 = max_age.rounded(5) - age.rounded(5)
+    d1 = age.value - min_age.value
+    d2 = max_age.value - age.value
     # Estimate error bars from basic propagation
     metric = "asymmetric range"
-    if d1 == d2:
+    if math.isclose(d1, d2, abs_tol=1e-5):
         metric = "symmetric range"
-    data["AGE"].error = Decimal(round((d1 + d2) / 2, 5))
+    data["AGE"].error = round((d1 + d2) / 2, 5)
     data["AGE"].error_metric = metric
 
 
 def combine_repeated_columns(df):
-    """Take the first value of duplicate columns and drop the rest."""
+    """
+    Take the first non-null value of duplicate columns and drop the rest. Units and
+    methods follow the copy that their value was taken from.
+    """
     # Clean column names by removing trailing digits and whitespace
-    for column_name in df.columns:
-        # Strip pandas-created suffixes for repeated columns
-        cleaned_column_name = re.sub(r"\.\d+$", "", column_name).strip()
-        if cleaned_column_name == column_name:
-            # No need to change anything
-            continue
-
-        if cleaned_column_name not in df.columns:
-            # We need to improve our column name
-            df.rename(columns={column_name: cleaned_column_name}, inplace=True)
-            continue
-
-        df.loc[:, cleaned_column_name].combine_first(df.loc[:, column_name])
-        df.drop(columns=[column_name], inplace=True)
+    df.columns = pandas.Index([_SUFFIX_RE.sub("", c).strip() for c in df.columns])
+    duplicated = df.columns.duplicated()
+    if not duplicated.any():
+        return df
+    # Only the repeated labels need merging; other columns keep their dtypes.
+    labels = df.columns[duplicated].unique()
+    # For each row, the copy of a value column holding its first non-null value
+    picks = {}
+    for label in labels:
+        if not label.endswith((" UNIT", " METH")):
+            group = df.loc[:, label]
+            picks[label] = (group.shape[1], group.notna().to_numpy().argmax(axis=1))
+
+    merged = {}
+    for label in labels:
+        group = df.loc[:, label]
+        first = group.notna().to_numpy().argmax(axis=1)
+        if label.endswith((" UNIT", " METH")):
+            # Take units and methods from the same copy as their value, so that
+            # a datum isn't assembled from different measurements.
+            n_copies, pick = picks.get(label[:-5], (None, None))
+            if n_copies == group.shape[1]:
+                first = pick
+        values = group.to_numpy(dtype=object)[N.arange(len(group)), first]
+        merged[label] = pandas.Series(values, index=df.index).infer_objects()
+    df = df.loc[:, ~duplicated].copy()
+    for label, values in merged.items():
+        df[label] = values
     return df
 
 
 def duplicate_indexes(df, col_name) -> List[int]:
-    ix = list(df.columns).index(col_name)
-    for ix_1, column_name_1 in enumerate(df.columns[ix + 1 :]):
-        if column_name_1 == col_name:
-            yield ix_1 + ix
+    """Positions of all but the first column with a given name."""
+    ix = N.flatnonzero(df.columns.to_numpy() == col_name)
+    return ix[1:].tolist()
 
 
 def meters_per_degree(lat: float) -> float:
@@ -235,5 +448,6 @@ def meters_per_degree(lat: float) -> float:
     https://stackoverflow.com/questions/639695/how-to-convert-latitude-or-longitude-to-meters
     We need this function because Sparrow stores measurement precision in meters, not degrees.
     """
-    cos_lat = N.cos(N.radians(lat))
-    return 111132.92 - 559.82 * cos_lat ** 2 + 1.175 * cos_lat ** 4
+    cos_lat = math.cos(math.radians(lat))
+    cos_lat_sq = cos_lat * cos_lat
+    return 111132.92 - 559.82 * cos_lat_sq + 1.175 * cos_lat_sq * cos_lat_sq